@@ -140,7 +140,7 @@ def print_list(lst, indent=0):
 # Core Logic
 #
 
-def send_req(server, req_name):
+def send_req(otc, server, req_name):
     '''
     Send request to the OFX server.
     '''
@@ -161,7 +161,6 @@ def send_req(server, req_name):
             cached = False
 
     if not cache or not cached:
-        otc = testofx.OFXTestClient(output=debug, tls_verify=server.get_tls())
         res = otc.send_req(req_name, server)
 
         # Store result for analysis
@@ -532,9 +531,16 @@ def main():
     print('Start: {}'.format(time.asctime()))
     print('  Checking TLS')
     check_tls(server, args.tls_verify)
-    for req_name in requests:
-        print('  Sending {}'.format(req_name))
-        send_req(server, req_name)
+    # One client for the whole scan, so its request cache (including
+    # negative entries for dead hosts) and pooled TLS connection span
+    # all of the requests.
+    with testofx.OFXTestClient(
+            output=debug,
+            tls_verify=server.get_tls()
+            ) as otc:
+        for req_name in requests:
+            print('  Sending {}'.format(req_name))
+            send_req(otc, server, req_name)
     print('  Analysing Server')
     try:
         profrs = testofx.OFXFile(req_results[testofx.REQ_NAME_OFX_PROFILE].text)
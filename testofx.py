@@ -4,10 +4,15 @@
 OFX Test Client
 """
 
+import hashlib
 import json
 import re
 import requests
+import sys
 import time
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urlparse
 from uuid import uuid4
 from xmltodict import parse as xmlparse
@@ -35,6 +40,15 @@ HDR_FIELDS_V1 = [HDR_OFXHEADER, HDR_DATA, HDR_VERSION, HDR_SECURITY,
 HDR_FIELDS_V2 = [HDR_OFXHEADER, HDR_VERSION, HDR_SECURITY, HDR_OLDFILEUID,
         HDR_NEWFILEUID]
 
+# Compiled once at import so batch parsing doesn't rebuild the pattern
+# (or hit the re module cache) per file.
+_V1_HDR_RE = re.compile(r'^([A-Z0-9]+):([^\r\n]*)$', re.MULTILINE)
+
+_V2_HEADER_RE = re.compile(
+        r'<\?OFX OFXHEADER="(?P<OFXHEADER>\d+)" VERSION="(?P<VERSION>\d+)"'
+        r' SECURITY="(?P<SECURITY>\w+)" OLDFILEUID="(?P<OLDFILEUID>\w+)"'
+        r' NEWFILEUID="(?P<NEWFILEUID>\w+)"\?>')
+
 OFX_HEADER_100 = \
 '''OFXHEADER:100
 DATA:OFXSGML
@@ -78,21 +92,151 @@ REQ_METHODS = {
     REQ_NAME_OFX_ACCTINFO: 'POST'
 }
 
+#
+# Payload Templates
+#
+# Hoisted to module scope so the payload builders don't rebuild the large
+# format strings on every call.
+#
+
+_FI_SGML_FMT =  \
+'''<FI>
+<ORG>{org}
+<FID>{fid}
+</FI>
+'''
+
+_FI_XML_FMT =  \
+'''<FI>
+<ORG>{org}</ORG>
+<FID>{fid}</FID>
+</FI>
+'''
+
+_SIGNON_SGML_FMT = \
+'''<SIGNONMSGSRQV1>
+<SONRQ>
+<DTCLIENT>{dt}
+<USERID>anonymous00000000000000000000000
+<USERPASS>anonymous00000000000000000000000
+<GENUSERKEY>N
+<LANGUAGE>ENG
+{fi}<APPID>QWIN
+<APPVER>2700
+</SONRQ>
+</SIGNONMSGSRQV1>'''
+
+_SIGNON_XML_FMT = \
+'''<SIGNONMSGSRQV1>
+<SONRQ>
+<DTCLIENT>{dt}</DTCLIENT>
+<USERID>anonymous00000000000000000000000</USERID>
+<USERPASS>anonymous00000000000000000000000</USERPASS>
+<GENUSERKEY>N</GENUSERKEY>
+<LANGUAGE>ENG</LANGUAGE>
+{fi}<APPID>QWIN</APPID>
+<APPVER>2700</APPVER>
+</SONRQ>
+</SIGNONMSGSRQV1>'''
+
+_OFX_EMPTY_BODY = \
+'''<OFX>
+</OFX>
+'''
+
+_PROFILE_SGML_FMT = \
+'''<OFX>
+{signonmsg}
+<PROFMSGSRQV1>
+<PROFTRNRQ>
+<TRNUID>{uid}
+<PROFRQ>
+<CLIENTROUTING>MSGSET
+<DTPROFUP>19900101
+</PROFRQ>
+</PROFTRNRQ>
+</PROFMSGSRQV1>
+</OFX>
+'''
+
+_PROFILE_XML_FMT = \
+'''<OFX>
+{signonmsg}
+<PROFMSGSRQV1>
+<PROFTRNRQ>
+<TRNUID>{uid}</TRNUID>
+<PROFRQ>
+<CLIENTROUTING>MSGSET</CLIENTROUTING>
+<DTPROFUP>19900101</DTPROFUP>
+</PROFRQ>
+</PROFTRNRQ>
+</PROFMSGSRQV1>
+</OFX>
+'''
+
+_ACCTINFO_FMT = \
+'''<OFX>
+{signonmsg}
+<SIGNUPMSGSRQV1>
+<ACCTINFOTRNRQ>
+<TRNUID>{uid}
+<ACCTINFORQ>
+<DTACCTUP>19900101
+</ACCTINFORQ>
+</ACCTINFOTRNRQ>
+</SIGNUPMSGSRQV1>
+</OFX>
+'''
+
+_INVSTMTRN_FMT = \
+'''<OFX>
+{signonmsg}
+<INVSTMTMSGSRQV1>
+<INVSTMTTRNRQ>
+<TRNUID>{uid}
+<INVSTMTRQ>
+<INVACCTFROM>
+<BROKERID>{broker_id}
+<ACCTID>{acct_id}
+</INVACCTFROM>
+<INCTRAN>
+<INCLUDE>Y
+</INCTRAN>
+<INCOO>Y
+<INCPOS>
+<INCLUDE>Y
+</INCPOS>
+<INCBAL>Y
+</INVSTMTRQ>
+</INVSTMTTRNRQ>
+</INVSTMTMSGSRQV1>
+</OFX>
+'''
+
 #
 # Helper Functions
 #
 
 def print_http_response(res):
-    print("===Request Headers===")
-    print(dict(res.request.headers))
-    print("===Request Body===")
-    print(res.request.body)
-    print("=== Response Status ===")
-    print(res.status_code)
-    print("=== Response Headers ===")
-    print(dict(res.headers))
-    print("=== Response Body ===")
-    print(res.text)
+    # Iterate the header mappings directly rather than copying them into
+    # fresh dicts, and emit one write per response.
+    out = []
+    out.append("===Request Headers===")
+    out.extend('{}: {}'.format(k, v) for k, v in res.request.headers.items())
+    out.append("===Request Body===")
+    # The body is pre-encoded bytes; decode for a readable transcript.
+    body = res.request.body
+    if isinstance(body, bytes):
+        out.append(body.decode('utf-8', 'replace'))
+    else:
+        out.append(str(body))
+    out.append("=== Response Status ===")
+    out.append(str(res.status_code))
+    out.append("=== Response Headers ===")
+    out.extend('{}: {}'.format(k, v) for k, v in res.headers.items())
+    out.append("=== Response Body ===")
+    out.append(res.text)
+    sys.stdout.write('\n'.join(out) + '\n')
 
 #
 # Public Functions
@@ -100,26 +244,33 @@ def print_http_response(res):
 
 def dt_now():
     # Example: 20170616141327.123[-7:MST]
-    return time.strftime("%Y%m%d%H%M%S.123[-7:MST]", time.localtime())
+    # The sub-second and timezone fields are fixed literals, so format the
+    # struct_time fields directly rather than interpreting a strftime
+    # format string on every payload build.
+    t = time.localtime()
+    return '{:04d}{:02d}{:02d}{:02d}{:02d}{:02d}.123[-7:MST]'.format(
+            t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
 
 
 def uid():
-    # Example: C1B7C870-7CB2-1000-BD91-E1E23E560026
-    return str(uuid4()).upper()
+    # OFX accepts the undashed hex form, which skips building the
+    # canonical dashed string just to uppercase it.
+    # Example: C1B7C8707CB21000BD91E1E23E560026
+    return uuid4().hex.upper()
 
 
 def is_ofx_response(resp_body):
-    ret = False
+    # Either header variant must appear near the start of the document,
+    # so only scan a fixed-size prefix instead of a potentially
+    # multi-MB response body.
+    head = resp_body[:256]
 
     # Version 1 Header
-    if resp_body.startswith('OFXHEADER'):
-        ret = True
+    if head.startswith('OFXHEADER'):
+        return True
 
     # Version 2 Header
-    if resp_body.find('<?OFX OFXHEADER') != -1:
-        ret = True
-
-    return ret
+    return '<?OFX OFXHEADER' in head
 
 
 class OFXServerInstance():
@@ -369,38 +520,99 @@ class OFXServerInstance():
 
 class OFXTestClient():
 
-    _payload_func = {}
-
     # Whether to print to stdout
     _output = True
 
-    cache = {}
-
     def __init__(self,
             timeout=(3.2, 27),
             wait=0,
             use_cache=False,
             output=False,
             version='102',
-            tls_verify=True
+            tls_verify=True,
+            neg_ttl=60.0
             ):
         self.timeout = timeout
         self.wait = wait
         self.use_cache = use_cache
+        self._neg_ttl = neg_ttl
         self._output=output
         self.version = version
         self.tls_verify = tls_verify
 
+        # Per-instance so separate clients don't share (and endlessly grow)
+        # one cache.
+        self.cache = {}
+
+        # Rendered anonymous signon messages, keyed by FI and second.
+        self._signon_cache = OrderedDict()
+
+        # Reuse one TCP/TLS connection per host across requests instead of
+        # paying a fresh handshake for every call.
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        # Back off at the transport layer instead of sleeping in the
+        # cache-miss path, so only the retried request pays the wait.
+        # allowed_methods=None retries POSTs too: urllib3's default
+        # excludes them, but these anonymous OFX probes are effectively
+        # idempotent.
+        # raise_on_status=False returns the final 5xx response once the
+        # retries are exhausted; the fingerprinting and tests analyse it.
+        retries = Retry(
+                total=2,
+                backoff_factor=self.wait,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=None,
+                raise_on_status=False
+                )
+        adapter = HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=20,
+                max_retries=retries
+                )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
         if self.version[0] == '1':
             self.ofxheader = OFX_HEADER_100.format(version=self.version)
             self.content_type = 'text/sgml'
+            self._fi_fmt = _FI_SGML_FMT
+            self._signon_fmt = _SIGNON_SGML_FMT
+            self._profile_fmt = _PROFILE_SGML_FMT
         elif self.version[0] == '2':
             self.ofxheader = OFX_HEADER_200.format(version=self.version)
             self.content_type = 'text/xml'
+            self._fi_fmt = _FI_XML_FMT
+            self._signon_fmt = _SIGNON_XML_FMT
+            self._profile_fmt = _PROFILE_XML_FMT
         else:
             raise ValueError(
                     'Unknown OFX version number {}'.format(self.version))
 
+        self._ofx_prelude = self.ofxheader + '\n'
+
+        # Payload builder for each pre-defined request
+        self._payload_func = {
+            REQ_NAME_GET_ROOT:     self.get_empty_payload,
+            REQ_NAME_GET_OFX:      self.get_empty_payload,
+            REQ_NAME_POST_OFX:     self.get_empty_payload,
+            REQ_NAME_OFX_EMPTY:    self.get_ofx_empty_payload,
+            REQ_NAME_OFX_PROFILE:  self.get_profile_payload,
+            REQ_NAME_OFX_ACCTINFO: self.get_acctinfo_payload
+        }
+
+    def close(self):
+        '''
+        Release the pooled connections held by the underlying session.
+        '''
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def call_url_cached(self, url, tls_verify, body, method):
         '''
         return (request.response, boolean) - Response and whether it was
@@ -418,24 +630,51 @@ class OFXTestClient():
         if method == 'POST':
             headers['Content-Type'] = CONTENT_TYPE
 
-        # Simple in memory cache to avoid duplicate calls to the same URL.
+        # Encode the payload once up front; the bytes feed both the cache
+        # digest and the request itself, instead of requests re-encoding
+        # the string into a second copy at send time.
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        # Simple in memory cache to avoid duplicate calls.
+        # Key on the full request, not just the URL: different payloads to
+        # the same OFX endpoint (PROFILE vs ACCTINFO) are different requests.
+        body_digest = hashlib.blake2b(
+                body if body else b'',
+                digest_size=16
+                ).digest()
+        key = (method, url, body_digest)
+
+        # Connection failures are a property of the endpoint, not the
+        # payload, so negative entries are cached as (None, expiry) under
+        # the URL alone and cool down every request to that endpoint.
+        # After the TTL lapses they are retried instead of being pinned
+        # for the process lifetime.
+        try:
+            expiry = self.cache[url][1]
+        except KeyError:
+            pass
+        else:
+            if time.monotonic() < expiry:
+                return (None, True)
+            del self.cache[url]
+
         try:
-            r = self.cache[url]
-            return (r, True)
+            return (self.cache[key], True)
         except KeyError:
             pass
 
         if self._output: print("{}".format(url))
         try:
             if method == 'GET':
-                r = requests.get(
+                r = self.session.get(
                         url,
                         headers=headers,
                         timeout=self.timeout,
                         verify=tls_verify
                         )
             elif method == 'POST':
-                r = requests.post(
+                r = self.session.post(
                         url,
                         headers=headers,
                         timeout=self.timeout,
@@ -443,19 +682,17 @@ class OFXTestClient():
                         data=body
                         )
             if self.use_cache:
-                self.cache[url] = r
+                self.cache[key] = r
             return (r, False)
         except requests.ConnectionError as ex:
             if self._output: print('\tConnectionError: {}'.format(ex))
-            # Set cache, but empty, to avoid further calls this run
-            # Still cache connection errors even if use_cache == False
-            self.cache[url] = None
+            # Set cache, but empty, to avoid further calls until the TTL
+            # expires. Still cache connection errors even if
+            # use_cache == False
+            self.cache[url] = (None, time.monotonic() + self._neg_ttl)
         except requests.exceptions.ReadTimeout as ex:
-            if self._output: print('\tConnectionError: {}'.format(ex))
-            if wait > 0:
-                if self._output:
-                    print('\tWaiting for {} seconds'.format(self.wait))
-                time.sleep(self.wait)
+            if self._output: print('\tReadTimeout: {}'.format(ex))
+            self.cache[url] = (None, time.monotonic() + self._neg_ttl)
 
         return (None, False)
 
@@ -476,218 +713,92 @@ class OFXTestClient():
         Send a pre-defined request to the OFX server.
         '''
 
-        res = None
+        try:
+            payload_func = self._payload_func[req_name]
+        except KeyError:
+            raise ValueError('Unknown request name: {}'.format(req_name))
 
         if req_name == REQ_NAME_GET_ROOT:
             parsed = urlparse(si.ofxurl)
             url = parsed.scheme + '://' + parsed.netloc
-            res, was_cached = self.call_url_cached(
-                    url,
-                    self.tls_verify,
-                    self.get_empty_payload(si),
-                    REQ_METHODS[req_name]
-                    )
-        elif req_name == REQ_NAME_GET_OFX:
-            res, was_cached = self.call_url_cached(
-                    si.ofxurl,
-                    self.tls_verify,
-                    self.get_empty_payload(si),
-                    REQ_METHODS[req_name]
-                    )
-        elif req_name == REQ_NAME_POST_OFX:
-            res, was_cached = self.call_url_cached(
-                    si.ofxurl,
-                    self.tls_verify,
-                    self.get_empty_payload(si),
-                    REQ_METHODS[req_name]
-                    )
-        elif req_name == REQ_NAME_OFX_EMPTY:
-            res, was_cached = self.call_url_cached(
-                    si.ofxurl,
-                    self.tls_verify,
-                    self.get_ofx_empty_payload(si),
-                    REQ_METHODS[req_name]
-                    )
-        elif req_name == REQ_NAME_OFX_PROFILE:
-            res, was_cached = self.call_url_cached(
-                    si.ofxurl,
-                    self.tls_verify,
-                    self.get_profile_payload(si),
-                    REQ_METHODS[req_name]
-                    )
         else:
-            raise ValueError('Unknown request name: {}'.format(req_name))
+            url = si.ofxurl
+
+        res, was_cached = self.call_url_cached(
+                url,
+                self.tls_verify,
+                payload_func(si),
+                REQ_METHODS[req_name]
+                )
 
         return res
 
     def _get_signonmsg_anonymous_payload(self, si):
 
-        if self.content_type == 'text/sgml':
-            ofx_fi_fmt =  \
-'''<FI>
-<ORG>{org}
-<FID>{fid}
-</FI>
-'''
-
-            ofx_signon_fmt = \
-'''<SIGNONMSGSRQV1>
-<SONRQ>
-<DTCLIENT>{dt}
-<USERID>anonymous00000000000000000000000
-<USERPASS>anonymous00000000000000000000000
-<GENUSERKEY>N
-<LANGUAGE>ENG
-{fi}<APPID>QWIN
-<APPVER>2700
-</SONRQ>
-</SIGNONMSGSRQV1>'''
-
-        elif self.content_type == 'text/xml':
-            ofx_fi_fmt =  \
-'''<FI>
-<ORG>{org}</ORG>
-<FID>{fid}</FID>
-</FI>
-'''
-
-            ofx_signon_fmt = \
-'''<SIGNONMSGSRQV1>
-<SONRQ>
-<DTCLIENT>{dt}</DTCLIENT>
-<USERID>anonymous00000000000000000000000</USERID>
-<USERPASS>anonymous00000000000000000000000</USERPASS>
-<GENUSERKEY>N</GENUSERKEY>
-<LANGUAGE>ENG</LANGUAGE>
-{fi}<APPID>QWIN</APPID>
-<APPVER>2700</APPVER>
-</SONRQ>
-</SIGNONMSGSRQV1>'''
+        # dt_now() is seconds resolution (the sub-second field is a
+        # hard-coded literal), so within one second the rendered signon is
+        # constant per FI and can be reused across payload builders.
+        now = int(time.time())
+        key = (si.fid, si.org, now) if si is not None else (None, None, now)
+        try:
+            return self._signon_cache[key]
+        except KeyError:
+            pass
 
         if si is None:
             fi = ''
         else:
-            fi = ofx_fi_fmt.format(
+            fi = self._fi_fmt.format(
                 fid=si.fid,
                 org=si.org
                 )
 
-        frag = ofx_signon_fmt.format(
+        frag = self._signon_fmt.format(
                 dt=dt_now(),
                 fi=fi
                 )
+
+        self._signon_cache[key] = frag
+        if len(self._signon_cache) > 4:
+            self._signon_cache.popitem(last=False)
+
         return frag
 
     def get_empty_payload(self, si):
         return ''
 
     def get_ofx_empty_payload(self, si):
-
-        ofx_body = \
-'''<OFX>
-</OFX>
-'''
-        return "{}{}{}".format(self.ofxheader, '\n', ofx_body)
+        return self._ofx_prelude + _OFX_EMPTY_BODY
 
     def get_profile_payload(self, si):
 
-        if self.content_type == 'text/sgml':
-            ofx_body_fmt = \
-'''<OFX>
-{signonmsg}
-<PROFMSGSRQV1>
-<PROFTRNRQ>
-<TRNUID>{uid}
-<PROFRQ>
-<CLIENTROUTING>MSGSET
-<DTPROFUP>19900101
-</PROFRQ>
-</PROFTRNRQ>
-</PROFMSGSRQV1>
-</OFX>
-'''
-
-        elif self.content_type == 'text/xml':
-            ofx_body_fmt = \
-'''<OFX>
-{signonmsg}
-<PROFMSGSRQV1>
-<PROFTRNRQ>
-<TRNUID>{uid}</TRNUID>
-<PROFRQ>
-<CLIENTROUTING>MSGSET</CLIENTROUTING>
-<DTPROFUP>19900101</DTPROFUP>
-</PROFRQ>
-</PROFTRNRQ>
-</PROFMSGSRQV1>
-</OFX>
-'''
-
-        body = ofx_body_fmt.format(
+        body = self._profile_fmt.format(
                 signonmsg=self._get_signonmsg_anonymous_payload(si),
                 uid=uid())
-        return "{}{}{}".format(self.ofxheader, '\n', body)
+        return self._ofx_prelude + body
 
     def get_acctinfo_payload(self, si):
         '''
         ACCTINFO Request payload
         '''
 
-        ofx_body_fmt = \
-'''<OFX>
-{signonmsg}
-<SIGNUPMSGSRQV1>
-<ACCTINFOTRNRQ>
-<TRNUID>{uid}
-<ACCTINFORQ>
-<DTACCTUP>19900101
-</ACCTINFORQ>
-</ACCTINFOTRNRQ>
-</SIGNUPMSGSRQV1>
-</OFX>
-'''
-
-        body = ofx_body_fmt.format(
+        body = _ACCTINFO_FMT.format(
                 signonmsg=self._get_signonmsg_anonymous_payload(si),
                 uid=uid())
-        return "{}{}{}".format(self.ofxheader, '\n', body)
+        return self._ofx_prelude + body
 
     def get_invstmtrn_payload(self, si, brokerid, acctid):
         '''
         INVSTMTTRRQ Request payload
         '''
 
-        ofx_body_fmt = \
-'''<OFX>
-{signonmsg}
-<INVSTMTMSGSRQV1>
-<INVSTMTTRNRQ>
-<TRNUID>{uid}
-<INVSTMTRQ>
-<INVACCTFROM>
-<BROKERID>{broker_id}
-<ACCTID>{acct_id}
-</INVACCTFROM>
-<INCTRAN>
-<INCLUDE>Y
-</INCTRAN>
-<INCOO>Y
-<INCPOS>
-<INCLUDE>Y
-</INCPOS>
-<INCBAL>Y
-</INVSTMTRQ>
-</INVSTMTTRNRQ>
-</INVSTMTMSGSRQV1>
-</OFX>
-'''
-        body = ofx_body_fmt.format(
+        body = _INVSTMTRN_FMT.format(
                 signonmsg=self._get_signonmsg_anonymous_payload(si),
                 uid=uid(),
                 broker_id=brokerid,
                 acct_id = acctid)
 
-        return "{}{}{}".format(self.ofxheader, '\n', body)
+        return self._ofx_prelude + body
 
 
 class OFXFile():
@@ -697,16 +808,14 @@ class OFXFile():
     This is simplistic parsing of specific fields, mainly the header and PROFRS
     '''
 
-    _file_str = ''
-    _v2_dict = {}
-
-    headers = {}
-    version = None
-    signon = {}
-    profile = {}
-
     def __init__(self, file_str):
         self._file_str = file_str
+        self._v2_dict = {}
+
+        self.headers = {}
+        self.version = None
+        self.signon = {}
+        self.profile = {}
 
         self._convert_newlines()
         self._parse_header()
@@ -724,7 +833,10 @@ class OFXFile():
         For now, just blindly Windows to Unix.
         '''
 
-        self._file_str = self._file_str.replace('\r\n', '\n')
+        # Skip the O(N) copy when the file is already Unix newlines;
+        # the containment check is a cheap C-level scan.
+        if '\r\n' in self._file_str:
+            self._file_str = self._file_str.replace('\r\n', '\n')
 
     def _parse_header(self):
         # Parse Version 1 Header
@@ -742,13 +854,12 @@ class OFXFile():
         # NEWFILEUID:NONE
 
         if self._file_str.startswith('OFXHEADER'):
-            # Assume well formed and parse based on NEWLINES
-            for line in self._file_str.splitlines():
-                # End of header
-                if line == '' or line.startswith('<OFX>') or len(line) > 13:
-                    break
-                [k,v] = line.split(':')
-                self.headers[k] = v
+            # Assume well formed and parse based on NEWLINES.
+            # Only scan up to <OFX>; the body can be megabytes and never
+            # contains header lines.
+            end = self._file_str.find('<OFX>')
+            hdr_slice = self._file_str[:end if end != -1 else 512]
+            self.headers = dict(_V1_HDR_RE.findall(hdr_slice))
 
             try:
                 self.version = int(self.headers[HDR_VERSION])
@@ -768,9 +879,7 @@ class OFXFile():
 
             # TODO: Pull ENCODING out of <?xml> declaration
 
-            rpat = r'<\?OFX OFXHEADER="(?P<OFXHEADER>\d+)" VERSION="(?P<VERSION>\d+)" SECURITY="(?P<SECURITY>\w+)" OLDFILEUID="(?P<OLDFILEUID>\w+)" NEWFILEUID="(?P<NEWFILEUID>\w+)"\?>'
-
-            match = re.search(rpat, self._file_str)
+            match = _V2_HEADER_RE.search(self._file_str)
             if not match:
                 raise ValueError("Parse Error: Unable to parse V2 header with regex")
             for field in HDR_FIELDS_V2:
@@ -778,7 +887,6 @@ class OFXFile():
 
             try:
                 self.version = int(self.headers[HDR_VERSION])
-                parsed = True
             except KeyError:
                 raise ValueError("Parse Error: No version")
 